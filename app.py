@@ -1,11 +1,22 @@
 # app.py - Helpy backend (cloud-ready)
 import os
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from supabase import create_client
-import requests
-import uuid
+import secrets
+import time
 import logging
+from contextlib import asynccontextmanager
+from typing import Annotated, Any
+import httpx
+import msgspec
+import orjson
+import redis.asyncio as redis
+from redis.exceptions import RedisError
+import stripe
+from cachetools import TTLCache
+from fastapi import BackgroundTasks, Depends, FastAPI, Query, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import Response
 
 # ---------- Config ----------
 SUPABASE_URL = os.getenv("SUPABASE_URL")
@@ -14,275 +25,486 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MAPBOX_TOKEN = os.getenv("MAPBOX_TOKEN")
 ZAPIER_WEBHOOK = os.getenv("ZAPIER_WEBHOOK")
 STRIPE_SECRET = os.getenv("STRIPE_SECRET")      # optional
+REDIS_URL = os.getenv("REDIS_URL")              # optional: shared cache + rate limit for read endpoints
+CACHE_TTL = int(os.getenv("CACHE_TTL", 30))
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", 0.2))    # seconds; a slow Redis falls back to Supabase
+RATE_LIMIT_PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", 0))    # per client on read endpoints, 0 = off
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 0))    # proxies in front that append X-Forwarded-For (Procfile: 1)
+CORS_ORIGINS = [o.strip() for o in (os.getenv("CORS_ORIGINS") or "https://helpy.app").split(",") if o.strip()]    # comma-separated
 
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise RuntimeError("SUPABASE_URL and SUPABASE_KEY must be set in env")
 
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+# only our own logger at INFO: httpx logs every request URL (incl. the Zapier hook) at INFO
+logging.basicConfig()
+logger = logging.getLogger("helpy")
+logger.setLevel(logging.INFO)
 
-app = Flask(__name__)
-CORS(app)
-app.logger.setLevel(logging.INFO)
+# ---------- HTTP clients ----------
+# Module-level clients so every request reuses pooled keep-alive connections
+# instead of paying a TCP+TLS handshake per call.
+POOL_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+
+def pooled_transport():
+    # retries only cover connect errors, so non-idempotent POSTs are never replayed
+    return httpx.AsyncHTTPTransport(http2=True, limits=POOL_LIMITS, retries=2)
+
+supabase = httpx.AsyncClient(
+    base_url=SUPABASE_URL.rstrip("/") + "/rest/v1",
+    headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+    transport=pooled_transport(),
+    timeout=10,
+)
+http = httpx.AsyncClient(transport=pooled_transport(), timeout=5)    # outbound webhooks (Zapier etc.)
+# short timeouts so an unreachable/hung Redis raises RedisError (logged, falls through)
+# instead of blocking every read, write and rate-limit check
+cache = redis.from_url(REDIS_URL, socket_connect_timeout=REDIS_TIMEOUT,
+                       socket_timeout=REDIS_TIMEOUT) if REDIS_URL else None
+
+class OrjsonResponse(Response):
+    """JSON response encoded by orjson (handlers pass plain dicts/lists via ok())"""
+    media_type = "application/json"
+
+    def render(self, content):
+        return orjson.dumps(content)
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    await supabase.aclose()
+    await http.aclose()
+    if cache is not None:
+        await cache.aclose()
+
+app = FastAPI(title="Helpy API", lifespan=lifespan, default_response_class=OrjsonResponse)
+app.add_middleware(GZipMiddleware, minimum_size=512, compresslevel=4)    # list endpoints compress 5-10x
+# browsers cache preflights for 24h, so most requests skip the OPTIONS round-trip
+app.add_middleware(CORSMiddleware, allow_origins=CORS_ORIGINS, allow_methods=["GET", "POST", "PUT"],
+                   allow_headers=["*"], expose_headers=["X-Next-After", "X-Next-After-Id"], max_age=86400)
+
+# ---------- Schemas ----------
+# Request bodies are decoded and then validated by msgspec (two C-level passes).
+# Only required fields are declared; any extra columns are passed through to
+# Supabase as-is.
+Text = Annotated[str, msgspec.Meta(min_length=1)]
+Id = Text | int
+
+class UserIn(msgspec.Struct):
+    name: Text
+    email: Text
+
+class ProductIn(msgspec.Struct):
+    shop_id: Id
+    name: str
+    price: float
+
+class OrderIn(msgspec.Struct):
+    customer_id: Id
+    total_amount: float
+    tracking_id: str | None = None
+
+class OrderStatusIn(msgspec.Struct):
+    status: Text
+
+class MessageIn(msgspec.Struct):
+    order_id: Id
+    sender: str
+    content: str
+
+class TicketIn(msgspec.Struct):
+    order_id: Id
+    issue: Text
+
+class DeliveryBoyIn(msgspec.Struct):
+    name: Text
+    phone: Text
+
+class AssignmentIn(msgspec.Struct):
+    order_id: Id
+    delivery_boy_id: Id
+
+class SettingIn(msgspec.Struct):
+    key: Text
+    value: Any = None
 
 # ---------- Helpers ----------
-def supabase_insert(table, payload):
+async def parse_body(request: Request, schema):
+    """Decode the JSON body to a dict, then validate that dict against schema.
+    Returns the raw dict so undeclared columns survive. Bad payloads raise
+    msgspec.DecodeError (-> 400, see handler below)"""
+    data = msgspec.json.decode(await request.body() or b"{}")
+    msgspec.convert(data, type=schema)
+    return data
+
+def ok(data, status=200):
+    # returning a Response directly skips FastAPI's jsonable_encoder pass
+    return OrjsonResponse(data, status_code=status)
+
+def error(message, status=500):
+    return OrjsonResponse({"error": message}, status_code=status)
+
+@app.exception_handler(msgspec.DecodeError)
+async def invalid_body(request: Request, exc: msgspec.DecodeError):
+    return error(str(exc), 400)
+
+@app.exception_handler(RequestValidationError)
+async def invalid_params(request: Request, exc: RequestValidationError):
+    # bad query/path params (e.g. ?limit=0): same {"error": ...} 400 as bad bodies
+    return error("; ".join(f"{e['loc'][-1]}: {e['msg']}" for e in exc.errors()), 400)
+
+class RateLimited(Exception):
+    pass
+
+@app.exception_handler(RateLimited)
+async def rate_limited(request: Request, exc: RateLimited):
+    return error("rate limit exceeded", 429)
+
+def client_ip(request: Request):
+    """Client address for rate limiting. Each of the TRUSTED_PROXY_HOPS proxies appends
+    the address it saw to X-Forwarded-For, so the entry added by the outermost one is
+    the real client; anything left of it is client-supplied and ignored."""
+    if TRUSTED_PROXY_HOPS:
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= TRUSTED_PROXY_HOPS:
+            return hops[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "-"
+
+async def rate_limit(request: Request):
+    """Fixed one-minute window per client IP, counted in Redis"""
+    if cache is None or not RATE_LIMIT_PER_MIN:
+        return
+    key = f"helpy:rl:{client_ip(request)}:{int(time.time()) // 60}"
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            hits, _ = await pipe.incr(key).expire(key, 60).execute()
+    except RedisError as e:
+        logger.warning("Rate limit check failed: %s", e)
+        return
+    if hits > RATE_LIMIT_PER_MIN:
+        raise RateLimited()
+
+def eq_filters(filters):
+    """{"col": val} -> PostgREST query params {"col": "eq.val"}"""
+    return {k: f"eq.{v}" for k, v in (filters or {}).items()}
+
+def pgrst_quote(v):
+    """Quote a value for use inside a PostgREST or=(...) / and=(...) filter"""
+    return '"' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+# Per-request constants hoisted so handlers don't rebuild them on every call
+RETURN_ROWS = {"Prefer": "return=representation"}
+UPSERT_ROWS = {"Prefer": "resolution=merge-duplicates,return=representation"}
+SINGLE_ROW = {"Accept": "application/vnd.pgrst.object+json"}    # PostgREST returns one object, not an array
+MESSAGES_ORDER = "created_at.asc,id.asc"    # id breaks ties between equal timestamps
+# columns returned by product listings; keep in sync with the INCLUDE list of products_shop_id_idx
+PRODUCT_COLUMNS = "id,shop_id,name,price,stock,image_url"
+
+def check(res, op):
+    if res.is_error:
+        logger.error("Supabase %s error: %s", op, res.text)
+        raise Exception(res.text)
+    return res.json() if res.content else []
+
+async def supabase_insert(table, payload):
     """Insert row and return inserted data (or raise)"""
-    res = supabase.table(table).insert(payload).execute()
-    if res.error:
-        app.logger.error("Supabase insert error: %s", res.error)
-        raise Exception(res.error)
-    return res.data
-
-def supabase_select(table, filters=None, single=False, order=None):
-    q = supabase.table(table).select("*")
-    if filters:
-        for k, v in filters.items():
-            q = q.eq(k, v)
+    res = await supabase.post(f"/{table}", json=payload, headers=RETURN_ROWS)
+    return check(res, "insert")
+
+async def supabase_select(table, filters=None, single=False, order=None, limit=None, extra=None, columns="*"):
+    """extra: raw PostgREST params, e.g. {"created_at": "gt.<ts>"}"""
+    params = {"select": columns, **eq_filters(filters), **(extra or {})}
     if order:
-        q = q.order(order)
-    res = q.execute()
-    if res.error:
-        app.logger.error("Supabase select error: %s", res.error)
-        raise Exception(res.error)
+        params["order"] = order
     if single:
-        return res.data[0] if res.data else None
-    return res.data
-
-def supabase_update(table, where: dict, payload: dict):
-    q = supabase.table(table)
-    for k, v in where.items():
-        q = q.eq(k, v)
-    res = q.update(payload).execute()
-    if res.error:
-        app.logger.error("Supabase update error: %s", res.error)
-        raise Exception(res.error)
-    return res.data
+        params["limit"] = 1
+        res = await supabase.get(f"/{table}", params=params, headers=SINGLE_ROW)
+        if res.status_code == 406:    # no matching row
+            return None
+        return check(res, "select")
+    if limit:
+        params["limit"] = limit
+    res = await supabase.get(f"/{table}", params=params)
+    return check(res, "select")
+
+# ---------- Read cache ----------
+# Each cached_select result is its own Redis key with a CACHE_TTL expiry (SET EX,
+# works on any Redis version), listed in a per-table index set. Handlers that
+# write a table call invalidate(table), which deletes every key in its index.
+# Redis errors only log; requests fall through to Supabase.
+async def cached_select(table, **kwargs):
+    if cache is None:
+        return await supabase_select(table, **kwargs)
+    index = f"helpy:cache:{table}"
+    key = index + ":" + orjson.dumps(kwargs, option=orjson.OPT_SORT_KEYS).decode()
+    try:
+        hit = await cache.get(key)
+        if hit is not None:
+            return orjson.loads(hit)
+    except RedisError as e:
+        logger.warning("Cache read failed: %s", e)
+    data = await supabase_select(table, **kwargs)
+    try:
+        async with cache.pipeline(transaction=False) as pipe:
+            await (pipe.set(key, orjson.dumps(data), ex=CACHE_TTL)
+                   .sadd(index, key).expire(index, CACHE_TTL).execute())
+    except RedisError as e:
+        logger.warning("Cache write failed: %s", e)
+    return data
+
+async def invalidate(table):
+    if cache is None:
+        return
+    index = f"helpy:cache:{table}"
+    try:
+        keys = await cache.smembers(index)
+        await cache.delete(index, *keys)
+    except RedisError as e:
+        logger.warning("Cache invalidate failed: %s", e)
+
+async def supabase_upsert(table, payload, on_conflict):
+    """Insert or update on conflict in a single round-trip"""
+    res = await supabase.post(f"/{table}", params={"on_conflict": on_conflict}, json=payload,
+                              headers=UPSERT_ROWS)
+    return check(res, "upsert")
+
+async def supabase_update(table, where: dict, payload: dict):
+    res = await supabase.patch(f"/{table}", params=eq_filters(where), json=payload,
+                               headers=RETURN_ROWS)
+    return check(res, "update")
+
+async def supabase_rpc(fn, params: dict):
+    """Call a Postgres function exposed by PostgREST"""
+    res = await supabase.post(f"/rpc/{fn}", json=params)
+    return check(res, "rpc")
 
 # ---------- Health ----------
-@app.route("/", methods=["GET"])
-def home():
-    return jsonify({"status": "ok", "message": "Helpy API running"}), 200
+# constant body encoded once; load balancer health checks hit this at high rate
+HEALTH_BODY = orjson.dumps({"status": "ok", "message": "Helpy API running"})
+
+@app.get("/")
+async def home():
+    return Response(HEALTH_BODY, media_type="application/json")
 
 # ---------- Users ----------
-@app.route("/users", methods=["POST"])
-def create_user():
-    data = request.json or {}
-    # basic validation
-    if not data.get("email") or not data.get("name"):
-        return jsonify({"error":"name and email required"}), 400
+@app.post("/users", status_code=201)
+async def create_user(request: Request):
+    data = await parse_body(request, UserIn)
     try:
-        out = supabase_insert("users", data)
-        return jsonify(out), 201
+        out = await supabase_insert("users", data)
+        await invalidate("users")
+        return ok(out, 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/users", methods=["GET"])
-def list_users():
+@app.get("/users", dependencies=[Depends(rate_limit)])
+async def list_users():
     try:
-        rows = supabase_select("users")
-        return jsonify(rows)
+        return ok(await cached_select("users"))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Products ----------
-@app.route("/products", methods=["POST"])
-def add_product():
-    data = request.json or {}
-    required = ["shop_id","name","price"]
-    if not all(k in data for k in required):
-        return jsonify({"error": f"required fields: {required}"}), 400
+@app.post("/products", status_code=201)
+async def add_product(request: Request):
+    data = await parse_body(request, ProductIn)
+    try:
+        out = await supabase_insert("products", data)
+        await invalidate("products")
+        return ok(out, 201)
+    except Exception as e:
+        return error(str(e))
+
+@app.get("/products", dependencies=[Depends(rate_limit)])
+async def get_products(shop_id: str | None = None):
     try:
-        out = supabase_insert("products", data)
-        return jsonify(out), 201
+        return ok(await cached_select("products", filters={"shop_id": shop_id} if shop_id else None,
+                                        columns=PRODUCT_COLUMNS))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/products", methods=["GET"])
-def get_products():
-    shop_id = request.args.get("shop_id")
-    q = supabase.table("products").select("*")
-    if shop_id:
-        q = q.eq("shop_id", shop_id)
-    res = q.execute()
-    if res.error:
-        return jsonify({"error": str(res.error)}), 500
-    return jsonify(res.data)
+        return error(str(e))
 
 # ---------- Orders ----------
-@app.route("/orders", methods=["POST"])
-def create_order():
-    data = request.json or {}
-    required = ["customer_id","total_amount"]
-    if not all(k in data for k in required):
-        return jsonify({"error": f"required fields: {required}"}), 400
+@app.post("/orders", status_code=201)
+async def create_order(request: Request):
+    data = await parse_body(request, OrderIn)
     # ensure tracking id
     if not data.get("tracking_id"):
-        data["tracking_id"] = str(uuid.uuid4())[:12]
+        data["tracking_id"] = secrets.token_hex(6)
     try:
-        out = supabase_insert("orders", data)
-        return jsonify(out), 201
+        return ok(await supabase_insert("orders", data), 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/orders/<tracking_id>", methods=["GET"])
-def get_order_by_tracking(tracking_id):
+@app.get("/orders/{tracking_id}")
+async def get_order_by_tracking(tracking_id: str):
     try:
-        rows = supabase_select("orders", filters={"tracking_id": tracking_id})
-        if not rows:
-            return jsonify({"error":"order not found"}), 404
-        return jsonify(rows[0])
+        row = await supabase_select("orders", filters={"tracking_id": tracking_id}, single=True)
+        if not row:
+            return error("order not found", 404)
+        return ok(row)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
-
-@app.route("/orders/id/<order_id>/status", methods=["PUT"])
-def update_order_status(order_id):
-    data = request.json or {}
-    status = data.get("status")
-    if not status:
-        return jsonify({"error":"status required"}), 400
+        return error(str(e))
+
+@app.put("/orders/id/{order_id}/status")
+async def update_order_status(order_id: str, request: Request):
+    status = (await parse_body(request, OrderStatusIn))["status"]
     try:
-        out = supabase_update("orders", {"id": order_id}, {"status": status})
-        return jsonify(out)
+        return ok(await supabase_update("orders", {"id": order_id}, {"status": status}))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Messages (chat history) ----------
-@app.route("/messages", methods=["POST"])
-def post_message():
-    data = request.json or {}
-    required = ["order_id","sender","content"]
-    if not all(k in data for k in required):
-        return jsonify({"error": f"required: {required}"}), 400
+@app.post("/messages", status_code=201)
+async def post_message(request: Request):
+    data = await parse_body(request, MessageIn)
     try:
-        out = supabase_insert("messages", data)
-        return jsonify(out), 201
+        return ok(await supabase_insert("messages", data), 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/messages/order/<order_id>", methods=["GET"])
-def fetch_messages_for_order(order_id):
+@app.get("/messages/order/{order_id}")
+async def fetch_messages_for_order(order_id: str, after: str | None = None, after_id: str | None = None,
+                                   limit: int = Query(200, ge=1, le=1000)):
+    # keyset pagination on (created_at, id), served by index messages_order_created.
+    # A full page carries X-Next-After / X-Next-After-Id headers: pass them back as
+    # ?after=&after_id= (URL-encoded) for the next page. No headers means this was the last page.
+    if after and after_id:
+        ts, mid = pgrst_quote(after), pgrst_quote(after_id)
+        extra = {"or": f"(created_at.gt.{ts},and(created_at.eq.{ts},id.gt.{mid}))"}
+    elif after:
+        extra = {"created_at": f"gt.{after}"}    # no id: rows sharing the boundary timestamp are skipped
+    else:
+        extra = None
     try:
-        q = supabase.table("messages").select("*").eq("order_id", order_id).order("created_at", {"ascending": True})
-        res = q.execute()
-        if res.error:
-            raise Exception(res.error)
-        return jsonify(res.data)
+        rows = await supabase_select("messages", filters={"order_id": order_id}, order=MESSAGES_ORDER,
+                                     limit=limit, extra=extra)
+        res = ok(rows)
+        if len(rows) == limit:
+            res.headers["X-Next-After"] = str(rows[-1]["created_at"])
+            res.headers["X-Next-After-Id"] = str(rows[-1]["id"])
+        return res
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Tickets ----------
-@app.route("/tickets", methods=["POST"])
-def create_ticket():
-    data = request.json or {}
-    if not data.get("issue") or not data.get("order_id"):
-        return jsonify({"error":"order_id and issue required"}), 400
+async def notify_zapier(ticket):
+    try:
+        await http.post(ZAPIER_WEBHOOK, json={
+            "ticket": ticket,
+        }, timeout=5)
+    except Exception as e:
+        logger.warning("Zapier webhook failed: %s", e)
+
+@app.post("/tickets", status_code=201)
+async def create_ticket(request: Request, background_tasks: BackgroundTasks):
+    data = await parse_body(request, TicketIn)
     try:
-        out = supabase_insert("tickets", data)
-        # optional: fire Zapier webhook
+        out = await supabase_insert("tickets", data)
+        await invalidate("tickets")
+        # optional: fire Zapier webhook after the response is sent
         if ZAPIER_WEBHOOK:
-            try:
-                requests.post(ZAPIER_WEBHOOK, json={
-                    "ticket": out,
-                }, timeout=5)
-            except Exception as e:
-                app.logger.warning("Zapier webhook failed: %s", e)
-        return jsonify(out), 201
+            background_tasks.add_task(notify_zapier, out)
+        return ok(out, 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/tickets", methods=["GET"])
-def list_tickets():
+@app.get("/tickets", dependencies=[Depends(rate_limit)])
+async def list_tickets():
     try:
-        rows = supabase_select("tickets")
-        return jsonify(rows)
+        return ok(await cached_select("tickets"))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Delivery Boys ----------
-@app.route("/delivery_boys", methods=["POST"])
-def create_delivery_boy():
-    data = request.json or {}
-    if not data.get("name") or not data.get("phone"):
-        return jsonify({"error":"name & phone required"}), 400
+@app.post("/delivery_boys", status_code=201)
+async def create_delivery_boy(request: Request):
+    data = await parse_body(request, DeliveryBoyIn)
     try:
-        out = supabase_insert("delivery_boys", data)
-        return jsonify(out), 201
+        out = await supabase_insert("delivery_boys", data)
+        await invalidate("delivery_boys")
+        return ok(out, 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/delivery_boys", methods=["GET"])
-def get_delivery_boys():
+@app.get("/delivery_boys", dependencies=[Depends(rate_limit)])
+async def get_delivery_boys():
     try:
-        rows = supabase_select("delivery_boys")
-        return jsonify(rows)
+        return ok(await cached_select("delivery_boys"))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Order Assignments ----------
-@app.route("/assign_order", methods=["POST"])
-def assign_order():
-    data = request.json or {}
-    if not data.get("order_id") or not data.get("delivery_boy_id"):
-        return jsonify({"error":"order_id and delivery_boy_id required"}), 400
+@app.post("/assign_order", status_code=201)
+async def assign_order(request: Request):
+    data = await parse_body(request, AssignmentIn)
     try:
-        out = supabase_insert("order_assignments", data)
-        # set delivery boy status to busy
-        try:
-            supabase_update("delivery_boys", {"id": data.get("delivery_boy_id")}, {"status":"busy"})
-        except Exception:
-            pass
-        return jsonify(out), 201
+        # insert assignment + set delivery boy status to busy in one transaction
+        # (see supabase/migrations/*_assign_order.sql)
+        row = await supabase_rpc("assign_order", {"payload": data})
+        await invalidate("delivery_boys")
+        return ok([row], 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/assignments/order/<order_id>", methods=["GET"])
-def get_assignment_for_order(order_id):
+@app.get("/assignments/order/{order_id}")
+async def get_assignment_for_order(order_id: str):
     try:
-        rows = supabase_select("order_assignments", filters={"order_id": order_id})
-        return jsonify(rows)
+        return ok(await supabase_select("order_assignments", filters={"order_id": order_id}))
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Admin Settings (control pricing / tokens /plan) ----------
 # Note: create a simple settings table in Supabase: settings (key text primary key, value jsonb)
-@app.route("/admin/settings", methods=["GET"])
-def get_settings():
+# Settings change rarely (only via set_setting), so reads are cached for CACHE_TTL.
+# With Redis the cache is shared and set_setting invalidates it for every worker;
+# without it each process keeps its own copy and other workers catch up on expiry.
+SETTINGS_CACHE = TTLCache(maxsize=1, ttl=CACHE_TTL)
+
+@app.get("/admin/settings", dependencies=[Depends(rate_limit)])
+async def get_settings():
     try:
-        rows = supabase_select("settings")
+        if cache is not None:
+            rows = await cached_select("settings")
+        else:
+            rows = SETTINGS_CACHE.get("settings")
+            if rows is None:
+                rows = SETTINGS_CACHE["settings"] = await supabase_select("settings")
         # return as key->value map
-        out = {r["key"]: r["value"] for r in rows} if rows else {}
-        return jsonify(out)
+        return ok({r["key"]: r["value"] for r in rows} if rows else {})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
-@app.route("/admin/settings", methods=["POST"])
-def set_setting():
-    data = request.json or {}
-    key = data.get("key")
+@app.post("/admin/settings", status_code=201)
+async def set_setting(request: Request):
+    data = await parse_body(request, SettingIn)
+    key = data["key"]
     value = data.get("value")
-    if not key:
-        return jsonify({"error":"key required"}), 400
     # upsert into settings
     try:
-        # delete old then insert (supabase upsert also possible)
-        supabase.table("settings").delete().eq("key", key).execute()
-        res = supabase.table("settings").insert({"key": key, "value": value}).execute()
-        if res.error:
-            raise Exception(res.error)
-        return jsonify(res.data[0]), 201
+        out = await supabase_upsert("settings", {"key": key, "value": value}, on_conflict="key")
+        SETTINGS_CACHE.clear()
+        await invalidate("settings")
+        return ok(out[0], 201)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error(str(e))
 
 # ---------- Payment webhook placeholder (Stripe) ----------
-@app.route("/webhook/stripe", methods=["POST"])
-def stripe_webhook():
-    # Implement signature verification using STRIPE_SECRET if you use Stripe
-    payload = request.get_json()
+@app.post("/webhook/stripe")
+async def stripe_webhook(request: Request):
+    if not STRIPE_SECRET:
+        return error("stripe webhook not configured", 503)
+    # verify the signature (constant-time HMAC) on the raw body before any JSON parsing
+    payload = await request.body()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get("stripe-signature"), STRIPE_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        return error("invalid signature", 400)
     # handle events here (payment.succeeded etc.)
-    app.logger.info("Stripe webhook event received")
-    return jsonify({"received": True})
+    logger.info("Stripe webhook event received: %s", event["type"])
+    return ok({"received": True})
 
 # ---------- Run ----------
 if __name__ == "__main__":
+    import uvicorn
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    # same queue bounds as the Procfile: extra connections get a 503 instead of piling up
+    uvicorn.run(app, host="0.0.0.0", port=port, backlog=512, limit_concurrency=200)
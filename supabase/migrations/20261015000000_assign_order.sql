@@ -0,0 +1,24 @@
+-- Assign an order to a delivery boy and mark them busy in a single transaction.
+-- Called from POST /assign_order via PostgREST: rpc/assign_order
+-- payload is the request body; only the keys it contains are inserted, so
+-- column defaults (id, created_at, ...) still apply and extra columns pass through.
+create or replace function public.assign_order(payload jsonb)
+returns json
+language plpgsql
+as $$
+declare
+  cols text;
+  assignment order_assignments;
+begin
+  select string_agg(quote_ident(k), ', ') into cols from jsonb_object_keys(payload) as k;
+
+  execute format(
+    'insert into order_assignments (%s) select %s from jsonb_populate_record(null::order_assignments, $1) returning *',
+    cols, cols
+  ) using payload into assignment;
+
+  update delivery_boys set status = 'busy' where id = assignment.delivery_boy_id;
+
+  return row_to_json(assignment);
+end;
+$$;
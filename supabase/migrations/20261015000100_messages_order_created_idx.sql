@@ -0,0 +1,2 @@
+-- Keyset pagination for GET /messages/order/<order_id>?after=<created_at>&after_id=<id>
+create index if not exists messages_order_created on messages (order_id, created_at, id);
@@ -0,0 +1,3 @@
+-- GET /products?shop_id=<id>: covers every column in PRODUCT_COLUMNS (app.py),
+-- so filtered listings can be answered by an index-only scan
+create index if not exists products_shop_id_idx on products (shop_id) include (id, name, price, stock, image_url);
@@ -0,0 +1,2 @@
+-- GET /orders/<tracking_id>: unique index lookup for single-row fetch
+create unique index if not exists orders_tracking_id_uniq on orders (tracking_id);